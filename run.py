@@ -1,35 +1,130 @@
 import argparse
 import concurrent.futures
+import contextlib
 import dataclasses
 import datetime
+import fractions
+import itertools
 import zoneinfo
-import io
 import json
 import logging
+import mmap
+import operator
 import os
+import queue
+import shutil
+import sqlite3
+import struct
+import subprocess
 import sys
+import threading
 import time
 
-import exif
+import exifread
 import ffmpeg
-import wand.image
+import PIL.Image
+import pillow_heif
+
+pillow_heif.register_heif_opener()
 
 MAX_CONFLICT_SUFFIXING = 10
 
-REMOVE_EXTENSIONS = ('.aae',)
+MAX_PENDING_PER_WORKER = 4
+MAX_PREFETCHED_FILES = 4096
+
+REMOVE_EXTENSIONS = frozenset({'.aae'})
+
+EXIF_IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg'})
+
+RENAME_EXTENSIONS = {'.jpeg': '.jpg'}
 
-EXIF_IMAGE_EXTENSIONS = ('.jpg')
+VIDEO_IMAGE_EXT = frozenset({'.mov', '.mp4'})
 
-VIDEO_IMAGE_EXT = ('.mov', '.mp4')
+# MOV/MP4 mvhd timestamps are seconds since this date
+MP4_EPOCH = datetime.datetime(1904, 1, 1, tzinfo=datetime.timezone.utc)
+UNIX_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+# like ffmpeg, smaller mvhd timestamps are seconds since the Unix epoch
+MP4_UNIX_EPOCH_SECONDS = int((UNIX_EPOCH - MP4_EPOCH).total_seconds())
+MP4_BOX_HEADER = struct.Struct('>I4s')
 
-TRANSFORM_IMAGE_EXTENSIONS = ('.jpeg', '.heic')
-TARGET_IMAGEMAGICK_FORMAT = 'jpeg'
-TARGET_IMAGEMAGICK_EXTENSION = '.jpg'
+TRANSFORM_IMAGE_EXTENSIONS = frozenset({'.heic'})
+TARGET_IMAGE_FORMAT = 'JPEG'
+TARGET_IMAGE_EXTENSION = '.jpg'
+TARGET_IMAGE_QUALITY = 92
+TARGET_IMAGE_MODES = ('RGB', 'L')
+
+EXTENSION_ACTIONS = {
+    **dict.fromkeys(REMOVE_EXTENSIONS, 'remove'),
+    **dict.fromkeys(TRANSFORM_IMAGE_EXTENSIONS, 'transform'),
+    **dict.fromkeys(EXIF_IMAGE_EXTENSIONS, 'exif'),
+    **dict.fromkeys(VIDEO_IMAGE_EXT, 'video'),
+}
+PROCESSED_EXTENSIONS = frozenset(extension[1:] for extension in EXTENSION_ACTIONS)
 
 TRACE_GPX = 'trace.gpx'
 
+CACHE_DATABASE = os.path.join(os.path.expanduser('~'), '.cache', 'camera-roll-uniformizer', 'state.db')
+# cache lookup result of unknown or modified files, None is for files without GPS data
+CACHE_MISS = object()
+GPX_HEADER = '''<?xml version="1.0" encoding="utf-8"?>
+<gpx version="1.0"
+creator="ExifTool 12.85"
+xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+xmlns="http://www.topografix.com/GPX/1/0"
+xsi:schemaLocation="http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd">
+<trk>
+<number>1</number>
+<trkseg>\n'''
+GPX_TRKPT = '<trkpt lat="%.7f" lon="%.7f"><ele>%.2f</ele><time>%s</time></trkpt>\n'
+GPX_FOOTER = '''</trkseg>
+</trk>
+</gpx>\n'''
+
+EXIFTOOL_EXECUTABLE = 'exiftool'
+EXIFTOOL_BATCH_SIZE = 1000
+# IFD0:ModifyDate is the TIFF DateTime tag (0x0132)
+EXIFTOOL_TAGS = {
+    'IFD0:ModifyDate': 'datetime',
+    'GPS:GPSLatitude': 'gps_latitude',
+    'GPS:GPSLatitudeRef': 'gps_latitude_ref',
+    'GPS:GPSLongitude': 'gps_longitude',
+    'GPS:GPSLongitudeRef': 'gps_longitude_ref',
+    'GPS:GPSAltitude': 'gps_altitude',
+    'GPS:GPSAltitudeRef': 'gps_altitude_ref',
+}
+
+# EXIF APP1 segment is expected within the first bytes of a JPEG file
+EXIF_HEADER_SIZE = 64 * 1024
+EXIF_APP1_HEADER = b'Exif\x00\x00'
+EXIF_GPS_IFD_POINTER = 0x8825
+EXIF_IFD0_TAGS = {0x0132: 'datetime', EXIF_GPS_IFD_POINTER: 'gps_ifd_pointer'}
+EXIF_GPS_TAGS = {
+    0x0001: 'gps_latitude_ref',
+    0x0002: 'gps_latitude',
+    0x0003: 'gps_longitude_ref',
+    0x0004: 'gps_longitude',
+    0x0005: 'gps_altitude_ref',
+    0x0006: 'gps_altitude',
+}
+EXIFREAD_TAGS = {
+    'Image DateTime': 'datetime',
+    'GPS GPSLatitude': 'gps_latitude',
+    'GPS GPSLatitudeRef': 'gps_latitude_ref',
+    'GPS GPSLongitude': 'gps_longitude',
+    'GPS GPSLongitudeRef': 'gps_longitude_ref',
+    'GPS GPSAltitude': 'gps_altitude',
+    'GPS GPSAltitudeRef': 'gps_altitude_ref',
+}
+EXIFREAD_STOP_TAG = 'GPSAltitude'
+GPS_ALTITUDE_ABOVE_SEA_LEVEL = 0
+GPS_ALTITUDE_BELOW_SEA_LEVEL = 1
+TIFF_FIELD_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8)}
+
 LOCAL_ZONE_INFO = zoneinfo.ZoneInfo('Asia/Tokyo')
 
+_created_directories = set()
+_created_directories_lock = threading.Lock()
+
 
 class MyError(Exception):
     pass
@@ -47,6 +142,10 @@ class FfmpegError(SkipFileError):
     pass
 
 
+class Mp4BoxError(SkipFileError):
+    pass
+
+
 class ExifError(SkipFileError):
     pass
 
@@ -59,8 +158,13 @@ class ExifGpsDataError(ExifError):
     pass
 
 
+class CacheError(MyError):
+    pass
+
+
 @dataclasses.dataclass(frozen=True)
 class GpsInfo:
+    # local date and time, despite the 'Z' suffix
     timestamp: str
     latitude: float
     longitude: float
@@ -68,225 +172,713 @@ class GpsInfo:
 
 
 def delete_file(path):
-    logging.debug(f'Removing file {path}')
+    logging.debug('Removing file %s', path)
     os.remove(path)
 
 
-def wand_transform_image(path, target_format, new_path):
-    if os.path.exists(new_path):
+def transform_image(path, target_format, new_path):
+    logging.info('Converting image %s to %s into %s', path, target_format, new_path)
+    try:
+        new_file = open(new_path, 'xb')
+    except FileExistsError as e:
         raise TargetExistsError(f'{new_path} already exists')
-    logging.info(f'Converting image {path} to {target_format} into {new_path}')
-    with wand.image.Image(filename=path) as original:
-        with original.convert(target_format) as converted:
-            converted.save(filename=new_path)
-            delete_file(path)
+    try:
+        with new_file, PIL.Image.open(path) as original, contextlib.ExitStack() as stack:
+            image = original
+            if original.mode not in TARGET_IMAGE_MODES:
+                image = stack.enter_context(original.convert('RGB'))
+            # keep EXIF data, needed to name the converted image
+            image.save(new_file, target_format, quality=TARGET_IMAGE_QUALITY, exif=original.info.get('exif', b''),
+                       icc_profile=original.info.get('icc_profile'))
+    except BaseException:
+        delete_file(new_path)
+        raise
+    delete_file(path)
     return new_path
 
 
-def exif_build_gps_coordinates(image, dt):
+def dms_to_decimal(dms, negative):
+    degrees, minutes, seconds = dms
+    decimal = degrees + minutes / 60.0 + seconds / 3600.0
+    return -decimal if negative else decimal
+
+
+def exif_build_gps_coordinates(image, dt, date_iso):
     lat = image.get('gps_latitude')
     lat_ref = image.get('gps_latitude_ref')
     lon = image.get('gps_longitude')
     lon_ref = image.get('gps_longitude_ref')
     alt = image.get('gps_altitude')
     alt_ref = image.get('gps_altitude_ref')
-    logging.debug(f'GPS: {lat=} {lat_ref=} {lon=} {lon_ref=} {alt=} {alt_ref=}')
+    logging.debug('GPS: lat=%r lat_ref=%r lon=%r lon_ref=%r alt=%r alt_ref=%r',
+                  lat, lat_ref, lon, lon_ref, alt, alt_ref)
     if alt is None or alt_ref is None:
         raise ExifGpsDataError('Missing GPS altitude in EXIF data')
     if lat is None or lat_ref is None:
         raise ExifGpsDataError('Missing GPS latitude in EXIF data')
     if lon is None or lon_ref is None:
         raise ExifGpsDataError('Missing GPS longitude in EXIF data')
-    if alt_ref not in (exif.GpsAltitudeRef.ABOVE_SEA_LEVEL, exif.GpsAltitudeRef.BELOW_SEA_LEVEL):
+    if alt_ref not in (GPS_ALTITUDE_ABOVE_SEA_LEVEL, GPS_ALTITUDE_BELOW_SEA_LEVEL):
         raise ExifGpsDataError('Invalid GPS altitude in EXIF data')
     if lat_ref not in ('N', 'S') or len(lat) != 3:
         raise ExifGpsDataError('Invalid GPS latitude in EXIF data')
     if lon_ref not in ('E', 'W') or len(lon) != 3:
         raise ExifGpsDataError('Invalid GPS longitude in EXIF data')
-    return GpsInfo(timestamp=dt.strftime('%Y-%m-%dT%H:%M:%SZ'),
-                   latitude=(lat[0] + lat[1] / 60.0 + lat[2] / 3600.0) * (-1 if lat_ref == 'S' else 1),
-                   longitude=(lon[0] + lon[1] / 60.0 + lon[2] / 3600.0) * (-1 if lon_ref == 'W' else 1),
-                   altitude=alt * (-1 if alt_ref == exif.GpsAltitudeRef.BELOW_SEA_LEVEL else 1))
+    timestamp = f'{date_iso}T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}Z'
+    return GpsInfo(timestamp=timestamp,
+                   latitude=dms_to_decimal(lat, lat_ref == 'S'),
+                   longitude=dms_to_decimal(lon, lon_ref == 'W'),
+                   altitude=-alt if alt_ref == GPS_ALTITUDE_BELOW_SEA_LEVEL else alt)
+
+
+class ExifTool:
+
+    def __init__(self, executable):
+        self.process = subprocess.Popen([executable, '-stay_open', 'True', '-@', '-'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.process.stdin.write('-stay_open\nFalse\n')
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def get_tags(self, paths):
+        arguments = ['-json', '-n', '-charset', 'filename=utf8', *(f'-{tag}' for tag in EXIFTOOL_TAGS), *paths,
+                     '-execute']
+        self.process.stdin.write('\n'.join(arguments) + '\n')
+        self.process.stdin.flush()
+        lines = []
+        for line in self.process.stdout:
+            if line.rstrip() == '{ready}':
+                break
+            lines.append(line)
+        output = ''.join(lines)
+        return json.loads(output) if output.strip() else []
+
+
+def exiftool_entry_to_tags(entry):
+    tags = {}
+    for tag, attribute in EXIFTOOL_TAGS.items():
+        value = entry.get(tag.partition(':')[2])
+        if value is None:
+            continue
+        # -n prints decimal degrees, rebuild the (degrees, minutes, seconds) layout
+        if attribute in ('gps_latitude', 'gps_longitude'):
+            value = (value, 0.0, 0.0)
+        tags[attribute] = value
+    return tags
+
+
+def create_exiftool():
+    executable = shutil.which(EXIFTOOL_EXECUTABLE)
+    if executable is None:
+        logging.info('exiftool not found, reading EXIF information file by file')
+        return None
+    logging.info('Getting EXIF informations using %s', executable)
+    return ExifTool(executable)
+
+
+def exif_batch_get_information(exiftool, paths):
+    if exiftool is None or not paths:
+        return {}
+    logging.debug('Getting EXIF informations for %d files', len(paths))
+    entries = exiftool.get_tags(paths)
+    return {os.path.normpath(entry['SourceFile']): exiftool_entry_to_tags(entry) for entry in entries}
+
+
+def get_files_exif_tags(files, exiftool):
+    files = iter(files)
+    while batch := list(itertools.islice(files, EXIFTOOL_BATCH_SIZE)):
+        exif_paths = [path for path in batch if get_low_extension(path) in EXIF_IMAGE_EXTENSIONS]
+        exif_tags = exif_batch_get_information(exiftool, exif_paths)
+        for path in batch:
+            yield path, exif_tags.get(os.path.normpath(path))
+
+
+def tiff_read_ifd(tiff, byte_order, offset, tags):
+    values = {}
+    count, = struct.unpack_from(f'{byte_order}H', tiff, offset)
+    for entry_offset in range(offset + 2, offset + 2 + count * 12, 12):
+        tag, field_type, field_count = struct.unpack_from(f'{byte_order}HHI', tiff, entry_offset)
+        if tag not in tags:
+            continue
+        field_format, field_size = TIFF_FIELD_TYPES[field_type]
+        value_offset = entry_offset + 8
+        if field_size * field_count > 4:
+            value_offset, = struct.unpack_from(f'{byte_order}I', tiff, value_offset)
+        if field_format == 's':
+            value, = struct.unpack_from(f'{field_count}s', tiff, value_offset)
+            value = value.split(b'\x00', 1)[0].decode('ascii')
+        elif field_format == 'II':
+            numbers = struct.unpack_from(f'{byte_order}{2 * field_count}I', tiff, value_offset)
+            value = tuple(numerator / denominator for numerator, denominator in zip(numbers[::2], numbers[1::2]))
+        else:
+            value = struct.unpack_from(f'{byte_order}{field_count}{field_format}', tiff, value_offset)
+        values[tags[tag]] = value[0] if field_count == 1 and not isinstance(value, str) else value
+    return values
+
+
+def exif_parse_app1(buffer):
+    if buffer[:2] != b'\xff\xd8':
+        return None
+    offset = 2
+    while offset + 4 <= len(buffer):
+        marker, length = struct.unpack_from('>HH', buffer, offset)
+        # stop at start of scan
+        if marker == 0xffda or marker & 0xff00 != 0xff00:
+            return None
+        if marker == 0xffe1 and buffer[offset + 4:offset + 10] == EXIF_APP1_HEADER:
+            tiff = memoryview(buffer)[offset + 10:offset + 2 + length]
+            if len(tiff) != length - 8:
+                return None
+            byte_order = {b'II': '<', b'MM': '>'}[bytes(tiff[:2])]
+            ifd0_offset, = struct.unpack_from(f'{byte_order}I', tiff, 4)
+            tags = tiff_read_ifd(tiff, byte_order, ifd0_offset, EXIF_IFD0_TAGS)
+            gps_ifd_offset = tags.pop('gps_ifd_pointer', None)
+            if gps_ifd_offset is not None:
+                tags.update(tiff_read_ifd(tiff, byte_order, gps_ifd_offset, EXIF_GPS_TAGS))
+            return tags
+        offset += 2 + length
+    return None
 
 
-def exif_get_information(path):
-    # https://exiv2.org/tags.html
-    # https://exiftool.org/TagNames/EXIF.html
-    logging.debug(f'Getting EXIF informations for {path}')
+def exif_fast_read_tags(path):
     with open(path, 'rb') as file:
-        image = exif.Image(file)
-        if not image.has_exif:
-            raise ExifError(f'{path} has no exif information')
-        exif_version = image.get('exif_version', 'Unknown')
-        logging.debug(f'Exif version for {path}: {exif_version}')
-        try:
-            dt = image.datetime
-        except AttributeError as e:
-            raise ExifDateTimeError(f'{path} has no datetime information')
-        dt = datetime.datetime.strptime(image.datetime, '%Y:%m:%d %H:%M:%S')  # '2024:05:05 18:19:59'
-        dt = dt.replace(tzinfo=LOCAL_ZONE_INFO)
-        # build gps coordinates
-        gps_coord = None
-        try:
-            gps_coord = exif_build_gps_coordinates(image, dt)
-        except ExifGpsDataError as e:
-            logging.warning(f'Cannot use {path} GPS coordinates: {e}')
-        # build new name
-        date_iso = dt.strftime('%Y-%m-%d')
-        time_iso = dt.strftime('%H-%M-%S')
-        name = dt.strftime(f'{date_iso}_{time_iso}')
-        return name, date_iso, gps_coord
+        buffer = file.read(EXIF_HEADER_SIZE)
+    try:
+        return exif_parse_app1(buffer)
+    except (struct.error, KeyError, ValueError, ZeroDivisionError) as e:
+        logging.debug('Cannot parse %s EXIF header: %s', path, e)
+        return None
+
+
+def exifread_to_tags(entries):
+    tags = {}
+    for name, key in EXIFREAD_TAGS.items():
+        entry = entries.get(name)
+        if entry is None:
+            continue
+        if isinstance(entry.values, str):
+            tags[key] = entry.values
+            continue
+        values = tuple(float(value) if isinstance(value, fractions.Fraction) else value for value in entry.values)
+        tags[key] = values[0] if len(values) == 1 else values
+    return tags
+
+
+def exif_read_tags(path):
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise ExifError(f'{path} is empty')
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            if hasattr(mapping, 'madvise'):
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+            entries = exifread.process_file(mapping, details=False, stop_tag=EXIFREAD_STOP_TAG)
+    if not entries:
+        raise ExifError(f'{path} has no exif information')
+    exif_version = entries.get('EXIF ExifVersion', 'Unknown')
+    logging.debug('Exif version for %s: %s', path, exif_version)
+    return exifread_to_tags(entries)
 
 
-def dump_ffmpeg_infos(path, infos):
-    with open(f'{path}.json', 'wt') as f:
-        json.dump(infos, f, sort_keys=True, indent=4)
+def format_date_name(dt):
+    date_iso = f'{dt.year:04d}-{dt.month:02d}-{dt.day:02d}'
+    return f'{date_iso}_{dt.hour:02d}-{dt.minute:02d}-{dt.second:02d}', date_iso
 
 
-def ffmpeg_get_information(path):
-    logging.debug(f'Getting FFMPEG timestamp name for {path}')
+def parse_exif_datetime(value, tzinfo):
+    # '2024:05:05 18:19:59'
+    return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]),
+                             int(value[17:19]), tzinfo=tzinfo)
+
+
+def exif_get_information(path, tags=None):
+    # https://exiv2.org/tags.html
+    # https://exiftool.org/TagNames/EXIF.html
+    logging.debug('Getting EXIF informations for %s', path)
+    if tags is None:
+        tags = exif_fast_read_tags(path)
+    if tags is None:
+        tags = exif_read_tags(path)
+    dt = tags.get('datetime')
+    if dt is None:
+        raise ExifDateTimeError(f'{path} has no datetime information')
+    try:
+        dt = parse_exif_datetime(dt, LOCAL_ZONE_INFO)
+    except ValueError as e:
+        raise ExifDateTimeError(f'{path} has invalid datetime information {dt!r}')
+    # build new name
+    name, date_iso = format_date_name(dt)
+    # build gps coordinates
+    gps_coord = None
+    try:
+        gps_coord = exif_build_gps_coordinates(tags, dt, date_iso)
+    except ExifGpsDataError as e:
+        logging.warning('Cannot use %s GPS coordinates: %s', path, e)
+    return name, date_iso, gps_coord
+
+
+def mp4_find_box(file, box_type, start, end):
+    offset = start
+    while offset + MP4_BOX_HEADER.size <= end:
+        file.seek(offset)
+        size, current_type = MP4_BOX_HEADER.unpack(file.read(MP4_BOX_HEADER.size))
+        header_size = MP4_BOX_HEADER.size
+        if size == 1:
+            size, = struct.unpack('>Q', file.read(8))
+            header_size += 8
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            raise Mp4BoxError(f'Invalid {current_type} box size {size}')
+        if current_type == box_type:
+            return offset + header_size, min(offset + size, end)
+        offset += size
+    raise Mp4BoxError(f'No {box_type} box found')
+
+
+def mp4_get_creation_time(path):
+    with open(path, 'rb') as file:
+        file_size = file.seek(0, os.SEEK_END)
+        try:
+            moov_start, moov_end = mp4_find_box(file, b'moov', 0, file_size)
+            mvhd_start, mvhd_end = mp4_find_box(file, b'mvhd', moov_start, moov_end)
+            file.seek(mvhd_start)
+            header = file.read(12)
+            version = header[0]
+            if version == 1:
+                creation_time, = struct.unpack_from('>Q', header, 4)
+            else:
+                creation_time, = struct.unpack_from('>I', header, 4)
+        except (struct.error, IndexError) as e:
+            raise Mp4BoxError(f'Truncated box in {path}')
+    if creation_time == 0:
+        raise FfmpegError(f'{path} has no mvhd creation time')
+    if creation_time < MP4_UNIX_EPOCH_SECONDS:
+        return UNIX_EPOCH + datetime.timedelta(seconds=creation_time)
+    return MP4_EPOCH + datetime.timedelta(seconds=creation_time)
+
+
+def ffprobe_get_creation_time(path):
     infos = ffmpeg.probe(path)
-    # dump_ffmpeg_infos(path, infos)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('ffprobe informations for %s: %s', path, json.dumps(infos))
     try:
         # MOV/MP4: format / tags / creation_time = '2024-05-12T05:38:26.000000Z'
         # MOV: format / tags / com.apple.quicktime.creationdate = '2024-05-12T14:38:26+0900'
         creation_time = infos['format']['tags']['creation_time']
     except KeyError as e:
         raise FfmpegError(f'{path} has no ffmpeg creation time')
-    dt = datetime.datetime.strptime(creation_time, '%Y-%m-%dT%H:%M:%S.%fZ')
-    dt = dt.replace(tzinfo=datetime.timezone.utc)
-    dt = dt.astimezone(LOCAL_ZONE_INFO)
-    date_iso = dt.strftime('%Y-%m-%d')
-    time_iso = dt.strftime('%H-%M-%S')
-    name = dt.strftime(f'{date_iso}_{time_iso}')
+    try:
+        # '2024-05-12T05:38:26.000000Z', 'Z' is only understood by fromisoformat from python 3.11
+        dt = datetime.datetime.fromisoformat(creation_time.replace('Z', '+00:00'))
+    except ValueError as e:
+        raise FfmpegError(f'{path} has invalid ffmpeg creation time {creation_time!r}')
+    if dt.tzinfo is None:
+        # without offset, the creation time is UTC
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
+
+
+def ffmpeg_get_information(path):
+    logging.debug('Getting FFMPEG timestamp name for %s', path)
+    try:
+        dt = mp4_get_creation_time(path)
+    except Mp4BoxError as e:
+        logging.debug('Falling back to ffprobe for %s: %s', path, e)
+        dt = ffprobe_get_creation_time(path)
+    name, date_iso = format_date_name(dt.astimezone(LOCAL_ZONE_INFO))
     # TODO: extract gps coordinates from video file ?
     gps_coord = None
     return name, date_iso, gps_coord
 
 
 def create_directory(path):
-    logging.debug(f'Creating {path} folder')
-    try:
-        os.mkdir(path)
-        logging.info(f'Created {path} folder')
-    except FileExistsError as e:
-        pass
+    if path in _created_directories:
+        return
+    with _created_directories_lock:
+        if path in _created_directories:
+            return
+        logging.debug('Creating %s folder', path)
+        try:
+            os.mkdir(path)
+            logging.info('Created %s folder', path)
+        except FileExistsError as e:
+            pass
+        _created_directories.add(path)
+
+
+def claim_file(path):
+    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+
+
+def get_path_key(path):
+    # same key for the different spellings of a path, e.g. './a.jpg' and 'a.jpg'
+    return os.path.normcase(os.path.abspath(path))
 
 
 def rename_file(src_path, dst_path):
-    logging.info(f'Renaming {src_path} into {dst_path}')
-    os.rename(src_path, dst_path)
+    try:
+        # symbolic links are moved themselves, not the files they point to
+        os.link(src_path, dst_path, follow_symlinks=False)
+    except FileExistsError:
+        # left by a run interrupted between link and unlink
+        if get_path_key(src_path) == get_path_key(dst_path):
+            raise
+        if not os.path.samestat(os.lstat(src_path), os.lstat(dst_path)):
+            raise
+        os.unlink(src_path)
+    except (OSError, NotImplementedError) as e:
+        # no hard link support (e.g. FAT file systems)
+        logging.debug('Cannot link %s into %s: %s', src_path, dst_path, e)
+        claim_file(dst_path)
+        try:
+            os.replace(src_path, dst_path)
+        except BaseException:
+            delete_file(dst_path)
+            raise
+    else:
+        try:
+            os.unlink(src_path)
+        except BaseException:
+            delete_file(dst_path)
+            raise
+    logging.info('Renamed %s into %s', src_path, dst_path)
 
 
 def rename_without_overwrite(path, new_name, out_directory, extension):
     create_directory(out_directory)
-    i = 0
-    while True:
+    for i in range(MAX_CONFLICT_SUFFIXING + 1):
         new_path = os.path.join(out_directory, f'{new_name}{extension}')
-        if not os.path.exists(new_path):
-            break
-        new_name = new_name + '_'
-        i = i + 1
-        if i > MAX_CONFLICT_SUFFIXING:
-            raise TargetExistsError(f'{new_path} still exists, not trying further prefixing')
-    rename_file(path, new_path)
+        if get_path_key(path) == get_path_key(new_path):
+            logging.debug('Keeping %s, already named', path)
+            return path
+        try:
+            rename_file(path, new_path)
+        except FileExistsError as e:
+            new_name = new_name + '_'
+            continue
+        return new_path
+    raise TargetExistsError(f'{new_path} still exists, not trying further prefixing')
 
 
-def process_media(path):
-    gps_coord = None
-    name, extension = os.path.splitext(os.path.basename(path))
-    low_extension = extension.lower()
+def get_low_extension(path):
+    separator = path.rfind(os.sep)
+    if os.altsep:
+        separator = max(separator, path.rfind(os.altsep))
+    dot = path.rfind('.')
+    if dot <= separator + 1:
+        return ''
+    return path[dot:].lower()
+
+
+def remove_media(path, low_extension, exif_tags):
     # remove useless files types
-    if low_extension in REMOVE_EXTENSIONS:
-        delete_file(path)
-        return
-    # convert to desired image format if needed
-    if low_extension in TRANSFORM_IMAGE_EXTENSIONS:
-        directory = os.path.dirname(path)
-        new_path = os.path.join(directory, f'{name}{TARGET_IMAGEMAGICK_EXTENSION}')
-        path = wand_transform_image(path, TARGET_IMAGEMAGICK_FORMAT, new_path)
-        name, extension = os.path.splitext(os.path.basename(path))
-        low_extension = extension.lower()
+    delete_file(path)
+    return None
+
+
+def transform_media(path, low_extension, exif_tags):
+    # convert to desired image format
+    new_path = f'{path[:-len(low_extension)]}{TARGET_IMAGE_EXTENSION}'
+    path = transform_image(path, TARGET_IMAGE_FORMAT, new_path)
+    return EXTENSION_HANDLERS[TARGET_IMAGE_EXTENSION](path, TARGET_IMAGE_EXTENSION, exif_tags)
+
+
+def exif_media(path, low_extension, exif_tags):
     # extract date and time, move and rename
-    if low_extension in EXIF_IMAGE_EXTENSIONS:
-        new_name, out_directory, gps_coord = exif_get_information(path)
-        rename_without_overwrite(path, new_name, out_directory, low_extension)
-    if low_extension in VIDEO_IMAGE_EXT:
-        new_name, out_directory, gps_coord = ffmpeg_get_information(path)
-        rename_without_overwrite(path, new_name, out_directory, low_extension)
-    return gps_coord
+    new_name, out_directory, gps_coord = exif_get_information(path, exif_tags)
+    new_path = rename_without_overwrite(path, new_name, out_directory,
+                                        RENAME_EXTENSIONS.get(low_extension, low_extension))
+    return new_path, gps_coord
+
 
+def video_media(path, low_extension, exif_tags):
+    new_name, out_directory, gps_coord = ffmpeg_get_information(path)
+    new_path = rename_without_overwrite(path, new_name, out_directory, low_extension)
+    return new_path, gps_coord
 
-def try_process_file(path):
+
+ACTION_HANDLERS = {
+    'remove': remove_media,
+    'transform': transform_media,
+    'exif': exif_media,
+    'video': video_media,
+}
+EXTENSION_HANDLERS = {extension: ACTION_HANDLERS[action] for extension, action in EXTENSION_ACTIONS.items()}
+
+
+def process_media(path, exif_tags=None):
+    low_extension = get_low_extension(path)
+    handler = EXTENSION_HANDLERS.get(low_extension)
+    return None if handler is None else handler(path, low_extension, exif_tags)
+
+
+def try_process_file(path, exif_tags=None):
     try:
-        return process_media(path)
+        return process_media(path, exif_tags)
     except SkipFileError as e:
-        logging.warning(f'Skipping file {path}: {e}')
+        logging.warning('Skipping file %s: %s', path, e)
     except Exception as e:
-        logging.error(f'Unknown exception, skipping file {path} due to : {e}')
+        logging.error('Unknown exception, skipping file %s due to : %s', path, e)
     return None
 
 
+def try_process_chunk(chunk):
+    results = []
+    for path, exif_tags in chunk:
+        result = try_process_file(path, exif_tags)
+        if result is not None:
+            results.append(result)
+    return results
+
+
 def write_gpx_trace(entries):
     logging.info('Writing GPX trace')
-    entries = sorted(entries, key=lambda d: d.timestamp)
-    with io.StringIO() as buf:
-        buf.write('''<?xml version="1.0" encoding="utf-8"?>
-            <gpx version="1.0"
-            creator="ExifTool 12.85"
-            xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-            xmlns="http://www.topografix.com/GPX/1/0"
-            xsi:schemaLocation="http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd">
-            <trk>
-            <number>1</number>
-            <trkseg>\n''')
-        for entry in entries:
-            buf.write(f'''<trkpt lat="{entry.latitude}" lon="{entry.longitude}">
-                <ele>{entry.altitude}</ele>
-                <time>{entry.timestamp}</time>
-                </trkpt>\n''')
-        buf.write('''</trkseg>
-               </trk>
-               </gpx>\n''')
-        with open(TRACE_GPX, 'w') as file:
-            file.write(buf.getvalue())
+    # photos taken in the same second are ordered by position
+    entries.sort(key=operator.attrgetter('timestamp', 'latitude', 'longitude'))
+    with open(TRACE_GPX, 'w', buffering=1 << 20) as file:
+        file.write(GPX_HEADER)
+        file.writelines(GPX_TRKPT % (entry.latitude, entry.longitude, entry.altitude, entry.timestamp)
+                        for entry in entries)
+        file.write(GPX_FOOTER)
+
+
+def is_processed_name(name):
+    _, dot, extension = name.rpartition('.')
+    return bool(dot) and extension.lower() in PROCESSED_EXTENSIONS
 
 
 def get_directory_files(directory):
-    for root, dirs, files in os.walk(directory):
-        for i, file in enumerate(files):
-            path = os.path.join(root, file)
-            yield path
-        for directory in dirs:
-            path = os.path.join(root, directory)
-            yield from get_directory_files(path)
+    directories = [directory]
+    while directories:
+        directory = directories.pop()
+        try:
+            # listed before yielding, files moved into this folder meanwhile are not found
+            with os.scandir(directory) as iterator:
+                entries = list(iterator)
+        except OSError as e:
+            logging.warning('Skipping folder %s: %s', directory, e)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif is_processed_name(entry.name):
+                yield entry.path
+            else:
+                logging.debug('Ignoring file %s', entry.path)
 
 
 def get_source_files(source):
     if os.path.isdir(source):
         yield from get_directory_files(source)
-    else:
+    elif is_processed_name(os.path.basename(source)):
         yield source
+    else:
+        logging.debug('Ignoring file %s', source)
 
 
 def get_sources_files(sources):
+    seen = set()
     for source in sources:
-        yield from get_source_files(source)
+        for path in get_source_files(source):
+            key = get_path_key(path)
+            if key in seen:
+                logging.debug('Ignoring duplicate file %s', path)
+                continue
+            seen.add(key)
+            yield path
 
 
-def process_files(files):
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        for result in executor.map(try_process_file, files):
-            if result is None:
-                continue
-            yield result
+def prefetch_files(files):
+    prefetched = queue.Queue(MAX_PREFETCHED_FILES)
+    stopped = threading.Event()
+    done = object()
+
+    def walk():
+        try:
+            for path in files:
+                prefetched.put(path)
+                if stopped.is_set():
+                    return
+            prefetched.put(done)
+        except BaseException as e:
+            prefetched.put(e)
+
+    thread = threading.Thread(target=walk, name='walk', daemon=True)
+    thread.start()
+    try:
+        while (path := prefetched.get()) is not done:
+            if isinstance(path, BaseException):
+                raise path
+            yield path
+    finally:
+        stopped.set()
+        with contextlib.suppress(queue.Empty):
+            while True:
+                prefetched.get_nowait()
+        thread.join()
+
+
+def default_workers(kind):
+    if kind == 'process':
+        return os.cpu_count() or 1
+    return min(32, (os.cpu_count() or 1) * 4)
+
+
+def create_executor(kind, workers):
+    if kind == 'process':
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+
+def create_executors(kind, workers):
+    if kind == 'hybrid':
+        thread_workers = workers or default_workers('thread')
+        process_workers = workers or default_workers('process')
+        return (create_executor('thread', thread_workers), create_executor('process', process_workers),
+                thread_workers + process_workers)
+    workers = workers or default_workers(kind)
+    executor = create_executor(kind, workers)
+    return executor, executor, workers
+
+
+def get_completed_results(futures):
+    for future in futures:
+        yield from future.result()
+
+
+def process_files(files_exif_tags, executor_kind, workers, chunksize):
+    default_executor, transform_executor, workers = create_executors(executor_kind, workers)
+    max_pending = MAX_PENDING_PER_WORKER * workers
+    with contextlib.ExitStack() as stack:
+        executors = {default_executor, transform_executor}
+        chunks = {stack.enter_context(executor): [] for executor in executors}
+        try:
+            pending = set()
+            for path, exif_tags in files_exif_tags:
+                if get_low_extension(path) in TRANSFORM_IMAGE_EXTENSIONS:
+                    executor = transform_executor
+                else:
+                    executor = default_executor
+                chunk = chunks[executor]
+                chunk.append((path, exif_tags))
+                if len(chunk) < chunksize:
+                    continue
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    yield from get_completed_results(done)
+                pending.add(executor.submit(try_process_chunk, chunk))
+                chunks[executor] = []
+            for executor, chunk in chunks.items():
+                if chunk:
+                    pending.add(executor.submit(try_process_chunk, chunk))
+            yield from get_completed_results(concurrent.futures.as_completed(pending))
+        except BaseException:
+            # interrupted or failed run, drop the files still queued
+            for executor in executors:
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+class ProcessedCache:
+
+    def __init__(self, path):
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(path)
+        except (OSError, sqlite3.Error) as e:
+            raise CacheError(f'Cannot open cache {path}: {e}')
+        try:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS processed '
+                                    '(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, gps_json TEXT)')
+        except sqlite3.Error as e:
+            self.connection.close()
+            raise CacheError(f'Cannot open cache {path}: {e}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.commit()
+        self.connection.close()
+
+    def lookup(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            return CACHE_MISS
+        row = self.connection.execute('SELECT mtime, size, gps_json FROM processed WHERE path = ?',
+                                      (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] != stat.st_mtime or row[1] != stat.st_size:
+            return CACHE_MISS
+        gps_coord = json.loads(row[2])
+        return None if gps_coord is None else GpsInfo(**gps_coord)
+
+    def store(self, path, gps_coord):
+        gps_json = json.dumps(None if gps_coord is None else dataclasses.asdict(gps_coord))
+        try:
+            stat = os.stat(path)
+            self.connection.execute('INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?)',
+                                    (os.path.abspath(path), stat.st_mtime, stat.st_size, gps_json))
+        except (OSError, sqlite3.Error) as e:
+            logging.warning('Cannot cache %s: %s', path, e)
+
+
+def filter_moved_files(files, moved):
+    # files moved by this run are found again when walking their date folder
+    for path in files:
+        if get_path_key(path) in moved:
+            logging.debug('Skipping file %s moved by this run', path)
+            continue
+        yield path
+
+
+def filter_cached_files(files, cache, gps_coords):
+    for path in files:
+        gps_coord = cache.lookup(path)
+        if gps_coord is CACHE_MISS:
+            yield path
+            continue
+        logging.debug('Skipping already processed file %s', path)
+        if gps_coord is not None:
+            gps_coords.append(gps_coord)
 
 
 def run(args):
     # TODO: provide hour shift to subprocesssing
-    files = get_sources_files(args.sources)
-    results = process_files(files)
-    write_gpx_trace(results)
+    with contextlib.ExitStack() as stack:
+        cache = None if args.no_cache else stack.enter_context(ProcessedCache(args.cache))
+        exiftool = create_exiftool()
+        if exiftool is not None:
+            stack.enter_context(exiftool)
+        files = prefetch_files(get_sources_files(args.sources))
+        stack.callback(files.close)
+        moved = set()
+        files = filter_moved_files(files, moved)
+        gps_coords = []
+        if cache is not None:
+            files = filter_cached_files(files, cache, gps_coords)
+        files_exif_tags = get_files_exif_tags(files, exiftool)
+        for new_path, gps_coord in process_files(files_exif_tags, args.executor, args.workers, args.chunksize):
+            key = get_path_key(new_path)
+            if key in moved:
+                # walked again before its first result came
+                continue
+            moved.add(key)
+            if cache is not None:
+                cache.store(new_path, gps_coord)
+            if gps_coord is not None:
+                gps_coords.append(gps_coord)
+    write_gpx_trace(gps_coords)
 
 
 def check_positive_int(value):
@@ -301,17 +893,22 @@ def main(argv=None):
         argv = sys.argv[1:]
     parser = argparse.ArgumentParser()
     parser.add_argument('sources', nargs='+')
+    parser.add_argument('--executor', choices=['thread', 'process', 'hybrid'], default='thread')
+    parser.add_argument('--workers', type=check_positive_int)
+    parser.add_argument('--chunksize', type=check_positive_int, default=1)
+    parser.add_argument('--cache', default=CACHE_DATABASE)
+    parser.add_argument('--no-cache', action='store_true')
     parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error', 'critical'], default='warning')
     args = parser.parse_args(argv)
     logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
                         level=getattr(logging, args.log_level.upper()))
 
-    logging.debug(f'Parsed arguments: {args}')
+    logging.debug('Parsed arguments: %s', args)
 
     try:
         start = time.perf_counter()
         run(args)
-        logging.info(f'Processing completed in {time.perf_counter() - start:.2f} seconds')
+        logging.info('Processing completed in %.2f seconds', time.perf_counter() - start)
     except MyError as e:
         logging.error(e)
 
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import PIL.Image
+
+import run
+
+
+def create_jpeg(path, date_time, gps=False):
+    exif = PIL.Image.Exif()
+    exif[0x0132] = date_time
+    if gps:
+        exif[0x8825] = {1: 'N', 2: (35.0, 30.0, 0.0), 3: 'E', 4: (139.0, 6.0, 0.0), 5: 0, 6: 12.3}
+    PIL.Image.new('RGB', (8, 8), 'red').save(path, exif=exif.tobytes())
+
+
+def list_files(directory):
+    return sorted(os.path.relpath(os.path.join(root, name), directory)
+                  for root, _, names in os.walk(directory) for name in names)
+
+
+class RunTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+        self.directory = directory.name
+        # relative date folders, remembered as created from the folder of the previous test
+        run._created_directories.clear()
+
+    def test_second_run_keeps_named_files(self):
+        for i in range(3):
+            create_jpeg(f'{i}.jpg', f'2024:05:05 18:19:5{i}')
+        run.main(['.', '--no-cache'])
+        files = list_files(self.directory)
+        self.assertEqual(files, ['2024-05-05/2024-05-05_18-19-50.jpg', '2024-05-05/2024-05-05_18-19-51.jpg',
+                                 '2024-05-05/2024-05-05_18-19-52.jpg', 'trace.gpx'])
+        run.main(['.', '--no-cache'])
+        self.assertEqual(list_files(self.directory), files)
+
+    def test_cache_errors_do_not_stop_the_run(self):
+        for i in range(3):
+            create_jpeg(f'{i}.jpg', f'2024:05:05 18:19:5{i}', gps=True)
+        with run.ProcessedCache('state.db') as cache:
+            cache.connection.execute("CREATE TRIGGER fail BEFORE INSERT ON processed "
+                                     "BEGIN SELECT RAISE(ABORT, 'failed'); END")
+        run.main(['.', '--cache', 'state.db'])
+        with open('trace.gpx') as file:
+            self.assertEqual(file.read().count('<trkpt '), 3)
+
+    def test_moved_files_are_not_walked_again(self):
+        # one file at a time, so files are moved while the folders are still walked
+        self.enterContext(unittest.mock.patch.object(run, 'MAX_PREFETCHED_FILES', 1))
+        self.enterContext(unittest.mock.patch.object(run, 'EXIFTOOL_BATCH_SIZE', 1))
+        os.mkdir('2024-05-05')
+        create_jpeg('2024-05-05/2024-05-05_00-00-00.jpg', '2024:05:05 00:00:00', gps=True)
+        for i in range(1, 200):
+            create_jpeg(f'{i}.jpg', f'2024:05:05 00:{i // 60:02d}:{i % 60:02d}', gps=True)
+        run.main(['.', '--no-cache'])
+        names = [f'2024-05-05/2024-05-05_00-{i // 60:02d}-{i % 60:02d}.jpg' for i in range(200)]
+        self.assertEqual(list_files(self.directory), [*names, 'trace.gpx'])
+        with open('trace.gpx') as file:
+            self.assertEqual(file.read().count('<trkpt '), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()